@@ -1,12 +1,21 @@
 import argparse
+import bisect
 import csv
+import heapq
+import io
+import itertools
 import json
 import logging
 import os
 import time
 import urllib.request
-from datetime import datetime
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from getpass import getpass
+from typing import Callable, List, NamedTuple, Optional
 
 from pypdf import PdfReader, PdfWriter
 
@@ -41,133 +50,772 @@ COINS = [
     "USD",
     "USDC",
     "DAI",
-    "LUNA",
     "WLUNA",
     "EOS",
 ]
 
 
-def create_consolidated_report(report_path: str):
-    # BlockFi
-    with open("data/blockfi_transaction_report_all.csv") as csv_file:
-        reader = csv.reader(csv_file)
-        rows = [row for row in reader]
-    blockfi_trade_rows = [row for row in rows if row[2] == "Trade"]
-    blockfi_reformatted_rows = [
-        [row[-1], row[0], row[1], "", "", "BlockFi"]
-        for row in blockfi_trade_rows
-        if row[0] != "DAI"
-    ]
-    blockfi_reformatted_rows = [
-        [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").isoformat()] + row[1:]
-        for row in blockfi_reformatted_rows
-    ]
+class SymbolRegistry:
+    """
+    Central registry of canonical asset symbols, along with per-exchange alias
+    tables mapping exchange asset codes to symbols and, where an exchange is
+    restricted, the set of symbols supported on it
+    """
 
-    # Coinbase
-    with open("data/coinbase-01012015-12312024.csv") as csv_file:
-        reader = csv.reader(csv_file)
-        rows = [row for row in reader]
-        rows = rows[3:]
-    coinbase_reformatted_rows = [
-        row + ["Coinbase"]
-        for row in rows
-        if row[1]
-        in [
-            "Convert",
-            "Buy",
-            "Advanced Trade Buy",
-            "Advanced Trade Sell",
-            "CardSpend",
-            "Sell",
-            "Card Spend",
-            "Card Buy Back",
-            # "Rewards Income",
-            # "Learning Reward",
-            "CardBuyBack",
-        ]
-        and row[2]
-        in [
-            "BTC",
-            "LTC",
-            "BCH",
-            "ETC",
-            "ETH",
-            "SHIB",
-            "DOGE",
-            "ADA",
-            "ATOM",
-            "SOL",
-            "DOT",
-            "MATIC",
-            "FIL",
-            "LINK",
-            "ZEC",
-        ]
-    ]
-    coinbase_reformatted_rows = [
-        [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S UTC").isoformat()] + row[1:]
-        for row in coinbase_reformatted_rows
-    ]
-    rows_prime = []
-    for row in coinbase_reformatted_rows:
-        if row[1] == "Buy":
-            comment = row[9]
-            words = comment.split()
-            amount, asset, dollars = words[1], words[2], words[4][1:]
-            rows_prime.append([row[0], asset, amount, row[5], dollars, row[-1]])
-        elif row[1] == "Convert":
-            comment = row[9]
-            words = comment.split()
-            amount_1, asset_1, amount_2, asset_2 = (
-                words[1],
-                words[2],
-                words[4],
-                words[5],
-            )
-            rows_prime.append([row[0], asset_1, -1 * float(amount_1), "", "", row[-1]])
-            rows_prime.append([row[0], asset_2, amount_2, "", "", row[-1]])
-        elif row[1] in ["CardSpend", "Card Spend"]:
-            rows_prime.append(
-                [
-                    row[0],
-                    row[2],
-                    -1 * float(row[3]),
-                    row[5],
-                    -1 * float(row[3]) * float(row[5]),
-                    row[-1],
-                ]
+    def __init__(self, symbols: List[str] = ()):
+        # dict as an insertion ordered set
+        self._symbols: dict[str, None] = {}
+        self._aliases: dict[str, dict] = {}
+        self._codes: dict[str, dict] = {}
+        self._supported: dict[str, frozenset] = {}
+        self._excluded: dict[str, frozenset] = {}
+        for symbol in symbols:
+            self.register(symbol)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._symbols
+
+    def __iter__(self):
+        return iter(self._symbols)
+
+    def register(self, symbol: str):
+        self._symbols[symbol] = None
+
+    def add_exchange(
+        self,
+        exchange: str,
+        aliases: Optional[dict] = None,
+        symbols: Optional[List[str]] = None,
+        codes: Optional[dict] = None,
+        excluded: Optional[List[str]] = None,
+    ):
+        """
+        Register an exchange
+
+        aliases: exchange asset code -> canonical symbol, for reading exchange data
+        symbols: canonical symbols supported on the exchange, all if None
+        codes: canonical symbol -> exchange asset code, for querying the exchange
+        excluded: exchange asset codes (fiat, stablecoins) not tracked as lots
+        """
+        self._aliases[exchange] = dict(aliases or {})
+        self._codes[exchange] = dict(codes or {})
+        self._excluded[exchange] = frozenset(excluded or ())
+        if symbols is not None:
+            self._supported[exchange] = frozenset(symbols)
+            for symbol in symbols:
+                self.register(symbol)
+
+    def normalize(self, exchange: str, code: str) -> str:
+        """
+        Return the canonical symbol for an exchange asset code
+        """
+        return self._aliases.get(exchange, {}).get(code, code)
+
+    def code(self, exchange: str, symbol: str) -> str:
+        """
+        Return the exchange asset code for a canonical symbol
+        """
+        return self._codes.get(exchange, {}).get(symbol, symbol)
+
+    def excludes(self, exchange: str, code: str) -> bool:
+        """
+        Return whether an exchange asset code is not tracked as lots
+        """
+        return code in self._excluded.get(exchange, ())
+
+    def supports(self, exchange: str, symbol: str) -> bool:
+        supported = self._supported.get(exchange)
+        if supported is None:
+            return symbol in self._symbols
+        return symbol in supported
+
+    def resolve(self, exchange: str, code: str) -> str:
+        """
+        Return the canonical symbol for an exchange asset code, raising
+        ValueError if it is not supported on the exchange
+        """
+        symbol = self.normalize(exchange, code)
+        if not self.supports(exchange, symbol):
+            raise ValueError(
+                f"unknown {exchange} asset code {code}. add it to SYMBOLS to track it"
             )
-        elif row[1] in ["CardBuyBack", "Card Buy Back"]:
-            rows_prime.append(
-                [row[0], row[2], row[3], row[5], float(row[3]) * float(row[5]), row[-1]]
-            )
-        elif row[1] == "Advanced Trade Buy":
-            rows_prime.append([row[0], row[2], row[3], row[5], row[7], row[-1]])
-        elif row[1] == "Advanced Trade Sell":
-            rows_prime.append(
-                [
-                    row[0],
-                    row[2],
-                    -1 * float(row[3]),
-                    row[5],
-                    -1 * float(row[7]),
-                    row[-1],
-                ]
+        return symbol
+
+
+SYMBOLS = SymbolRegistry(COINS)
+SYMBOLS.add_exchange("BlockFi", excluded=["DAI"])
+SYMBOLS.add_exchange(
+    "Coinbase",
+    symbols=[
+        "BTC",
+        "LTC",
+        "BCH",
+        "ETC",
+        "ETH",
+        "SHIB",
+        "DOGE",
+        "ADA",
+        "ATOM",
+        "SOL",
+        "DOT",
+        "MATIC",
+        "FIL",
+        "LINK",
+        "ZEC",
+    ],
+)
+SYMBOLS.add_exchange(
+    "Kraken",
+    aliases={
+        "XXBT": "BTC",
+        "XETH": "ETH",
+        "XXMR": "XMR",
+        "XXDG": "DOGE",
+    },
+    symbols=[
+        "BTC",
+        "ETH",
+        "XMR",
+        "SOL",
+        "ADA",
+        "LTC",
+        "DOGE",
+        "ATOM",
+        "DOT",
+        "MATIC",
+        "LUNA",
+        "APE",
+        "BCH",
+        "UST",
+        "USD",
+    ],
+    excluded=["ZUSD", "USDT", "LUNA2"],
+)
+SYMBOLS.add_exchange("Coinbase Pro", excluded=["USD", "USDT"])
+SYMBOLS.add_exchange("Uphold", excluded=["USD", "USDC", "DAI"])
+SYMBOLS.add_exchange("coinranking", codes={"USD": "USDC"})
+
+
+class PriceProvider(ABC):
+    """
+    Source of historical USD spot prices, keyed by symbol and unix timestamp
+    """
+
+    @abstractmethod
+    def get_price(self, symbol: str, timestamp: int) -> Optional[float]:
+        """
+        Return the USD price of symbol at timestamp, or None if this provider
+        has no price for it, so that the next provider may be tried
+        """
+
+
+class CsvPriceProvider(PriceProvider):
+    """
+    Price provider backed by local OHLC files, one per symbol, named
+    <SYMBOL>.csv in price_dir with rows of
+
+        timestamp,open,high,low,close[,...]
+
+    where timestamp is unix seconds, unix milliseconds or an iso format date.
+    Each file is loaded
+    once into sorted arrays and searched with bisect, using the close of the
+    latest bar at or before the requested timestamp. Bars older than max_gap
+    seconds are considered stale and no price is returned.
+    """
+
+    def __init__(self, price_dir: str, max_gap: int = 86400):
+        self.price_dir = price_dir
+        self.max_gap = max_gap
+        self._series: dict[str, tuple] = {}
+        self._warned: set = set()
+
+    def _load(self, symbol: str) -> tuple:
+        filename = os.path.join(self.price_dir, f"{symbol}.csv")
+        if not os.path.exists(filename):
+            log.debug(f"no price file {filename}")
+            return array("d"), array("d")
+        bars = []
+        with open(filename) as csv_file:
+            reader = csv.reader(csv_file)
+            for row in reader:
+                if len(row) < 5:
+                    continue
+                try:
+                    timestamp = float(row[0])
+                    if timestamp > 1e11:
+                        # milliseconds
+                        timestamp /= 1000
+                except ValueError:
+                    try:
+                        date = datetime.fromisoformat(row[0])
+                    except ValueError:
+                        # header
+                        continue
+                    if date.tzinfo is None:
+                        date = date.replace(tzinfo=timezone.utc)
+                    timestamp = date.timestamp()
+                try:
+                    close = float(row[4])
+                except ValueError:
+                    # gap filled bar
+                    continue
+                bars.append((timestamp, close))
+        bars.sort()
+        log.debug(f"loaded {len(bars)} bars from {filename}")
+        return array("d", [bar[0] for bar in bars]), array("d", [bar[1] for bar in bars])
+
+    def get_price(self, symbol: str, timestamp: int) -> Optional[float]:
+        if symbol not in self._series:
+            self._series[symbol] = self._load(symbol)
+        timestamps, prices = self._series[symbol]
+        index = bisect.bisect_right(timestamps, timestamp) - 1
+        if index < 0 or timestamp - timestamps[index] > self.max_gap:
+            if timestamps and symbol not in self._warned:
+                self._warned.add(symbol)
+                log.warning(
+                    f"{symbol} price file covers "
+                    + f"{datetime.fromtimestamp(timestamps[0], timezone.utc).isoformat()} to "
+                    + f"{datetime.fromtimestamp(timestamps[-1], timezone.utc).isoformat()}, "
+                    + f"not {datetime.fromtimestamp(timestamp, timezone.utc).isoformat()}"
+                )
+            return None
+        return prices[index]
+
+
+class CoinrankingPriceProvider(PriceProvider):
+    """
+    Price provider backed by the coinranking api. Coin uuids and histories are
+    fetched lazily and cached per symbol.
+    """
+
+    baseurl = "https://api.coinranking.com/v2"
+
+    def __init__(self, apikey_filename: str = ".apikey", time_period: str = "5y"):
+        self.apikey_filename = apikey_filename
+        self.time_period = time_period
+        self._headers = None
+        self._coins = None
+        self._series: dict[str, tuple] = {}
+
+    def _request(self, path: str) -> dict:
+        if self._headers is None:
+            with open(self.apikey_filename) as apikey_file:
+                apikey = apikey_file.read()
+            self._headers = {"x-access-token": apikey}
+        req = urllib.request.Request(self.baseurl + path, headers=self._headers)
+        ret = urllib.request.urlopen(req)
+        return json.load(ret)["data"]
+
+    def _load(self, symbol: str) -> tuple:
+        if self._coins is None:
+            codes = dict.fromkeys(SYMBOLS.code("coinranking", c) for c in SYMBOLS)
+            coin_query_str = "&".join(f"symbols[]={c}" for c in codes)
+            coins = self._request("/coins?" + coin_query_str)["coins"]
+            self._coins = {c["symbol"]: c for c in coins}
+
+        symbol_prime = SYMBOLS.code("coinranking", symbol)
+        coin_data = self._coins.get(symbol_prime)
+        if not coin_data:
+            raise ValueError(f"{symbol_prime} not found in list of coins from coinranking")
+        coin_history = self._request(
+            f"/coin/{coin_data['uuid']}/history?timePeriod={self.time_period}"
+        )["history"]
+        # weird case where price = None
+        history = sorted(
+            (h["timestamp"], float(h["price"])) for h in coin_history if h["price"]
+        )
+        return [h[0] for h in history], [h[1] for h in history]
+
+    def get_price(self, symbol: str, timestamp: int) -> Optional[float]:
+        if symbol not in self._series:
+            self._series[symbol] = self._load(symbol)
+        timestamps, prices = self._series[symbol]
+        index = bisect.bisect_left(timestamps, timestamp) - 1
+        if index < 0:
+            return None
+        return prices[index]
+
+
+class ExchangeAdapter(NamedTuple):
+    """
+    How to read an exchange export: rows are kept by row_filter and mapped by
+    row_transform to zero or more consolidated rows of
+
+        [date, symbol, amount, spot price, total cost, source]
+
+    Deposits and withdrawals are likewise kept by transfer_filter and mapped by
+    transfer_transform to rows of the same layout, negative amounts going out,
+    in the same pass over the file
+    """
+
+    source: str
+    filename: str
+    row_filter: Callable[[list], bool]
+    row_transform: Callable[[list], List[list]]
+    skip_rows: int = 0
+    transfer_filter: Optional[Callable[[list], bool]] = None
+    transfer_transform: Optional[Callable[[list], List[list]]] = None
+
+
+def _blockfi_row_filter(row: list) -> bool:
+    return row[2] == "Trade" and not SYMBOLS.excludes("BlockFi", row[0])
+
+
+def _blockfi_row_transform(row: list) -> List[list]:
+    symbol = SYMBOLS.resolve("BlockFi", row[0])
+    date = datetime.strptime(row[-1], "%Y-%m-%d %H:%M:%S").isoformat()
+    return [[date, symbol, row[1], "", "", "BlockFi"]]
+
+
+def _coinbase_row_filter(row: list) -> bool:
+    return row[1] in {
+        "Convert",
+        "Buy",
+        "Advanced Trade Buy",
+        "Advanced Trade Sell",
+        "CardSpend",
+        "Sell",
+        "Card Spend",
+        "Card Buy Back",
+        # "Rewards Income",
+        # "Learning Reward",
+        "CardBuyBack",
+    } and SYMBOLS.supports("Coinbase", SYMBOLS.normalize("Coinbase", row[2]))
+
+
+def _coinbase_row_transform(row: list) -> List[list]:
+    row = (
+        [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S UTC").isoformat()]
+        + row[1:2]
+        + [SYMBOLS.normalize("Coinbase", row[2])]
+        + row[3:]
+        + ["Coinbase"]
+    )
+    rows = []
+    if row[1] == "Buy":
+        comment = row[9]
+        words = comment.split()
+        amount, asset, dollars = words[1], words[2], words[4][1:]
+        asset = SYMBOLS.normalize("Coinbase", asset)
+        rows.append([row[0], asset, amount, row[5], dollars, row[-1]])
+    elif row[1] == "Convert":
+        comment = row[9]
+        words = comment.split()
+        amount_1, asset_1, amount_2, asset_2 = (
+            words[1],
+            words[2],
+            words[4],
+            words[5],
+        )
+        asset_1 = SYMBOLS.normalize("Coinbase", asset_1)
+        asset_2 = SYMBOLS.normalize("Coinbase", asset_2)
+        rows.append([row[0], asset_1, -1 * float(amount_1), "", "", row[-1]])
+        rows.append([row[0], asset_2, amount_2, "", "", row[-1]])
+    elif row[1] in {"CardSpend", "Card Spend"}:
+        rows.append(
+            [
+                row[0],
+                row[2],
+                -1 * float(row[3]),
+                row[5],
+                -1 * float(row[3]) * float(row[5]),
+                row[-1],
+            ]
+        )
+    elif row[1] in {"CardBuyBack", "Card Buy Back"}:
+        rows.append(
+            [row[0], row[2], row[3], row[5], float(row[3]) * float(row[5]), row[-1]]
+        )
+    elif row[1] == "Advanced Trade Buy":
+        rows.append([row[0], row[2], row[3], row[5], row[7], row[-1]])
+    elif row[1] == "Advanced Trade Sell":
+        rows.append(
+            [
+                row[0],
+                row[2],
+                -1 * float(row[3]),
+                row[5],
+                -1 * float(row[7]),
+                row[-1],
+            ]
+        )
+    elif row[1] == "Sell":
+        rows.append(
+            [
+                row[0],
+                row[2],
+                -1 * float(row[3]),
+                row[5],
+                -1 * float(row[7]),
+                row[-1],
+            ]
+        )
+    else:
+        rows.append(row)
+    return rows
+
+
+def _kraken_row_filter(row: list) -> bool:
+    return row[3] == "trade" and not SYMBOLS.excludes("Kraken", row[6])
+
+
+def _kraken_row_transform(row: list) -> List[list]:
+    symbol = SYMBOLS.resolve("Kraken", row[6])
+    date = datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S").isoformat()
+    return [[date, symbol, row[8], "", "", "Kraken"]]
+
+
+def _uphold_row_filter(row: list) -> bool:
+    return row[-1] != "out"
+
+
+def _uphold_row_transform(row: list) -> List[list]:
+    rows = []
+    date = datetime.strptime(row[0], "%a %b %d %Y %H:%M:%S GMT+0000").isoformat()
+    dest_amount = float(row[2])
+    dest_currency = SYMBOLS.resolve("Uphold", row[3])
+    origin_amount = float(row[8])
+    origin_currency = SYMBOLS.resolve("Uphold", row[9])
+    if dest_currency == origin_currency:
+        if dest_currency == "BAT":
+            # assume earnings, add for calculation into cost basis
+            rows.append([date, dest_currency, dest_amount, "", "", "Uphold"])
+    elif row[-1] == "transfer":
+        rows.append([date, origin_currency, -1 * origin_amount, "", "", "Uphold"])
+        if not SYMBOLS.excludes("Uphold", row[3]):
+            rows.append([date, dest_currency, dest_amount, "", "", "Uphold"])
+    elif row[-1] == "in":
+        assert origin_currency == "USD", f"{date} origin currency not USD for 'in' row"
+        rows.append(
+            [
+                date,
+                dest_currency,
+                dest_amount,
+                origin_amount / dest_amount,
+                origin_amount,
+                "Uphold",
+            ]
+        )
+    return rows
+
+
+def _transfer_asset_filter(exchange: str, code: str) -> bool:
+    # transfers of assets not tracked as lots can't be matched, skip them
+    return not SYMBOLS.excludes(exchange, code) and SYMBOLS.supports(
+        exchange, SYMBOLS.normalize(exchange, code)
+    )
+
+
+def _blockfi_transfer_row_filter(row: list) -> bool:
+    return row[2] in {"Crypto Transfer", "Withdrawal"} and _transfer_asset_filter(
+        "BlockFi", row[0]
+    )
+
+
+def _blockfi_transfer_row_transform(row: list) -> List[list]:
+    symbol = SYMBOLS.resolve("BlockFi", row[0])
+    date = datetime.strptime(row[-1], "%Y-%m-%d %H:%M:%S").isoformat()
+    return [[date, symbol, float(row[1]), "", "", "BlockFi"]]
+
+
+# moves to and from Coinbase Pro are recorded as deposits to / withdrawals
+# from Pro, or Exchange in older exports
+COINBASE_TRANSFERS_OUT = {"Send", "Pro Deposit", "Exchange Deposit"}
+COINBASE_TRANSFERS_IN = {"Receive", "Pro Withdrawal", "Exchange Withdrawal"}
+
+
+def _coinbase_transfer_row_filter(row: list) -> bool:
+    return (
+        row[1] in COINBASE_TRANSFERS_OUT or row[1] in COINBASE_TRANSFERS_IN
+    ) and _transfer_asset_filter("Coinbase", row[2])
+
+
+def _coinbase_transfer_row_transform(row: list) -> List[list]:
+    date = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S UTC").isoformat()
+    amount = abs(float(row[3]))
+    if row[1] in COINBASE_TRANSFERS_OUT:
+        amount = -1 * amount
+    symbol = SYMBOLS.normalize("Coinbase", row[2])
+    return [[date, symbol, amount, "", "", "Coinbase"]]
+
+
+def _coinbase_pro_transfer_row_filter(row: list) -> bool:
+    return row[1] in {"deposit", "withdrawal"} and _transfer_asset_filter(
+        "Coinbase Pro", row[5]
+    )
+
+
+def _coinbase_pro_transfer_row_transform(row: list) -> List[list]:
+    date_split = row[2].split(".")[0]
+    date = datetime.strptime(date_split + "Z", "%Y-%m-%dT%H:%M:%SZ").isoformat()
+    symbol = SYMBOLS.resolve("Coinbase Pro", row[5])
+    return [[date, symbol, float(row[3]), "", "", "Coinbase Pro"]]
+
+
+def _kraken_transfer_row_filter(row: list) -> bool:
+    return row[3] in {"deposit", "withdrawal"} and _transfer_asset_filter(
+        "Kraken", row[6]
+    )
+
+
+def _kraken_transfer_row_transform(row: list) -> List[list]:
+    symbol = SYMBOLS.resolve("Kraken", row[6])
+    date = datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S").isoformat()
+    return [[date, symbol, float(row[8]), "", "", "Kraken"]]
+
+
+def _uphold_transfer_row_filter(row: list) -> bool:
+    # same currency in / out of the account. same currency BAT rows are also
+    # booked as earnings by _uphold_row_transform, unless matched as a transfer
+    return (
+        row[3] == row[9]
+        and _transfer_asset_filter("Uphold", row[3])
+        and (row[-1] in {"in", "out"} or row[3] == "BAT")
+    )
+
+
+def _uphold_transfer_row_transform(row: list) -> List[list]:
+    symbol = SYMBOLS.resolve("Uphold", row[3])
+    date = datetime.strptime(row[0], "%a %b %d %Y %H:%M:%S GMT+0000").isoformat()
+    if row[-1] == "out":
+        return [[date, symbol, -1 * float(row[8]), "", "", "Uphold"]]
+    return [[date, symbol, float(row[2]), "", "", "Uphold"]]
+
+
+EXCHANGE_ADAPTERS = {
+    "BlockFi": ExchangeAdapter(
+        "BlockFi",
+        "data/blockfi_transaction_report_all.csv",
+        _blockfi_row_filter,
+        _blockfi_row_transform,
+        transfer_filter=_blockfi_transfer_row_filter,
+        transfer_transform=_blockfi_transfer_row_transform,
+    ),
+    "Coinbase": ExchangeAdapter(
+        "Coinbase",
+        "data/coinbase-01012015-12312024.csv",
+        _coinbase_row_filter,
+        _coinbase_row_transform,
+        skip_rows=3,
+        transfer_filter=_coinbase_transfer_row_filter,
+        transfer_transform=_coinbase_transfer_row_transform,
+    ),
+    "Kraken": ExchangeAdapter(
+        "Kraken",
+        "data/kraken-ledger-alltime-040924.csv",
+        _kraken_row_filter,
+        _kraken_row_transform,
+        transfer_filter=_kraken_transfer_row_filter,
+        transfer_transform=_kraken_transfer_row_transform,
+    ),
+    "Uphold": ExchangeAdapter(
+        "Uphold",
+        "data/uphold-transactions-040924.csv",
+        _uphold_row_filter,
+        _uphold_row_transform,
+        skip_rows=1,
+        transfer_filter=_uphold_transfer_row_filter,
+        transfer_transform=_uphold_transfer_row_transform,
+    ),
+}
+
+
+def match_transfers(
+    transfers: List[list],
+    window: int = 3 * 24 * 60 * 60,
+    tolerance: float = 0.05,
+    slack: int = 60 * 60,
+    epsilon: float = 1e-8,
+) -> tuple:
+    """
+    Pair outgoing transfers (negative amount) with incoming transfers of the
+    same symbol at another source, received within window seconds after being
+    sent, for an amount short of the amount sent by at most tolerance (fees).
+    Incoming transfers may be recorded up to slack seconds before being sent,
+    for clock skew between sources, and amounts may differ by epsilon for
+    rounding.
+
+    Incoming transfers are indexed per symbol by time, so each outgoing
+    transfer only looks at the incoming transfers inside its window.
+
+    Returns (matched, unmatched_out, unmatched_in), matched being a list of
+    (outgoing row, incoming row) pairs
+    """
+    incoming_index: dict[str, tuple] = {}
+    outgoing = []
+    for row in transfers:
+        symbol = row[1]
+        timestamp = datetime.fromisoformat(row[0]).timestamp()
+        if float(row[2]) < 0:
+            outgoing.append((timestamp, symbol, row))
+        else:
+            if symbol not in incoming_index:
+                incoming_index[symbol] = ([], [])
+            incoming_index[symbol][0].append(timestamp)
+            incoming_index[symbol][1].append(row)
+    for symbol, (timestamps, rows) in incoming_index.items():
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        incoming_index[symbol] = (
+            [timestamps[i] for i in order],
+            [rows[i] for i in order],
+            [False] * len(order),  # matched
+        )
+    outgoing.sort(key=lambda elem: elem[0])
+
+    matched = []
+    unmatched_out = []
+    for timestamp, symbol, out_row in outgoing:
+        if symbol not in incoming_index:
+            unmatched_out.append(out_row)
+            continue
+        timestamps, in_rows, in_matched = incoming_index[symbol]
+        amount = abs(float(out_row[2]))
+        j = bisect.bisect_left(timestamps, timestamp - slack)
+        while j < len(timestamps) and timestamps[j] <= timestamp + window:
+            in_row = in_rows[j]
+            if (
+                not in_matched[j]
+                and in_row[5] != out_row[5]
+                and amount * (1 - tolerance) - epsilon
+                <= float(in_row[2])
+                <= amount + epsilon
+            ):
+                in_matched[j] = True
+                matched.append((out_row, in_row))
+                break
+            j += 1
+        else:
+            unmatched_out.append(out_row)
+
+    unmatched_in = []
+    for timestamps, in_rows, in_matched in incoming_index.values():
+        unmatched_in += [row for row, m in zip(in_rows, in_matched) if not m]
+    unmatched_in.sort(key=lambda row: row[0])
+    return matched, unmatched_out, unmatched_in
+
+
+def _parse_csv_chunk(
+    filename: str,
+    start: int,
+    end: int,
+    row_filter: Callable[[list], bool],
+    row_transform: Callable[[list], List[list]],
+    transfer_filter: Optional[Callable[[list], bool]] = None,
+    transfer_transform: Optional[Callable[[list], List[list]]] = None,
+) -> tuple:
+    with open(filename, "rb") as csv_file:
+        csv_file.seek(start)
+        text = csv_file.read(end - start).decode("utf-8-sig")
+    reader = csv.reader(io.StringIO(text, newline=""))
+    rows = []
+    transfers = []
+    for row in reader:
+        if not row:
+            continue
+        if row_filter(row):
+            rows += row_transform(row)
+        if transfer_filter and transfer_filter(row):
+            transfers += transfer_transform(row)
+    rows.sort(key=lambda row: row[0])
+    transfers.sort(key=lambda row: row[0])
+    return rows, transfers
+
+
+def read_csv_chunked(
+    filename: str,
+    row_filter: Callable[[list], bool],
+    row_transform: Callable[[list], List[list]],
+    skip_rows: int = 0,
+    chunk_size: int = 32 * 1024 * 1024,
+    workers: Optional[int] = None,
+    transfer_filter: Optional[Callable[[list], bool]] = None,
+    transfer_transform: Optional[Callable[[list], List[list]]] = None,
+) -> List[tuple]:
+    """
+    Split a csv file into chunks of about chunk_size bytes on line boundaries and
+    parse the chunks in worker processes, applying row_filter and row_transform,
+    and transfer_filter and transfer_transform if given. Returns the
+    transformed (rows, transfers) of each chunk, sorted by date, for merging.
+
+    Note: fields containing newlines are not supported, since chunks are split
+    on line boundaries
+    """
+    with open(filename, "rb") as csv_file:
+        for _ in range(skip_rows):
+            csv_file.readline()
+        start = csv_file.tell()
+        size = os.fstat(csv_file.fileno()).st_size
+        boundaries = [start]
+        while boundaries[-1] + chunk_size < size:
+            csv_file.seek(boundaries[-1] + chunk_size)
+            csv_file.readline()
+            boundaries.append(csv_file.tell())
+        boundaries.append(size)
+    chunks = [(a, b) for a, b in zip(boundaries[:-1], boundaries[1:]) if a < b]
+
+    if len(chunks) <= 1 or workers == 1:
+        return [
+            _parse_csv_chunk(
+                filename,
+                a,
+                b,
+                row_filter,
+                row_transform,
+                transfer_filter,
+                transfer_transform,
             )
-        elif row[1] == "Sell":
-            rows_prime.append(
-                [
-                    row[0],
-                    row[2],
-                    -1 * float(row[3]),
-                    row[5],
-                    -1 * float(row[7]),
-                    row[-1],
-                ]
+            for a, b in chunks
+        ]
+    log.debug(f"parsing {filename} in {len(chunks)} chunks")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                _parse_csv_chunk,
+                itertools.repeat(filename),
+                [a for a, _ in chunks],
+                [b for _, b in chunks],
+                itertools.repeat(row_filter),
+                itertools.repeat(row_transform),
+                itertools.repeat(transfer_filter),
+                itertools.repeat(transfer_transform),
             )
-        else:
-            rows_prime.append(row)
-    coinbase_reformatted_rows = rows_prime
+        )
+
+
+def read_exchange_export(
+    adapter: ExchangeAdapter, workers: Optional[int] = None
+) -> tuple:
+    """
+    Read an exchange export into consolidated rows and transfer rows, each
+    sorted by date
+    """
+    chunks = read_csv_chunked(
+        adapter.filename,
+        adapter.row_filter,
+        adapter.row_transform,
+        skip_rows=adapter.skip_rows,
+        workers=workers,
+        transfer_filter=adapter.transfer_filter,
+        transfer_transform=adapter.transfer_transform,
+    )
+    rows = list(heapq.merge(*[c[0] for c in chunks], key=lambda row: row[0]))
+    transfers = list(heapq.merge(*[c[1] for c in chunks], key=lambda row: row[0]))
+    return rows, transfers
+
+
+def create_consolidated_report(
+    report_path: str,
+    price_providers: Optional[List["PriceProvider"]] = None,
+    workers: Optional[int] = None,
+    transfer_window: int = 3 * 24 * 60 * 60,
+    transfer_tolerance: float = 0.05,
+):
+    blockfi_reformatted_rows, blockfi_transfer_rows = read_exchange_export(
+        EXCHANGE_ADAPTERS["BlockFi"], workers=workers
+    )
+    coinbase_reformatted_rows, coinbase_transfer_rows = read_exchange_export(
+        EXCHANGE_ADAPTERS["Coinbase"], workers=workers
+    )
 
     # coinbase pro
     with open("data/coinbase-pro-account-010117-031323.csv") as csv_file:
@@ -175,6 +823,10 @@ def create_consolidated_report(report_path: str):
         rows = [row for row in reader]
         rows = rows[1:]
     coinbase_pro_match_rows = [row for row in rows if row[1] == "match"]
+    coinbase_pro_transfer_rows = []
+    for row in rows:
+        if _coinbase_pro_transfer_row_filter(row):
+            coinbase_pro_transfer_rows += _coinbase_pro_transfer_row_transform(row)
     # group by order-id
     match_orders = {}
     for row in coinbase_pro_match_rows:
@@ -189,9 +841,11 @@ def create_consolidated_report(report_path: str):
 
         orders = match_orders[order]
 
-        usd_match_rows = list(filter(lambda row: row[5] in ["USD", "USDT"], orders))
+        usd_match_rows = list(
+            filter(lambda row: SYMBOLS.excludes("Coinbase Pro", row[5]), orders)
+        )
         crypto_match_rows = list(
-            filter(lambda row: row[5] not in ["USD", "USDT"], orders)
+            filter(lambda row: not SYMBOLS.excludes("Coinbase Pro", row[5]), orders)
         )
         if len(usd_match_rows) == 2 and len(crypto_match_rows) == 0:
             # wash
@@ -232,7 +886,7 @@ def create_consolidated_report(report_path: str):
                     reformatted_rows.append(
                         [
                             date,
-                            row[5],
+                            SYMBOLS.resolve("Coinbase Pro", row[5]),
                             float(row[3]),
                             "",
                             "",
@@ -245,7 +899,7 @@ def create_consolidated_report(report_path: str):
             ):
                 usd_match_row = usd_match_rows_consolidated[0]
                 crypto_match_row = crypto_match_rows_consolidated[0]
-                symbol = crypto_match_row[5]
+                symbol = SYMBOLS.resolve("Coinbase Pro", crypto_match_row[5])
                 amount = float(crypto_match_row[3])
                 cost = -1 * float(usd_match_row[3])
                 reformatted_rows.append(
@@ -266,85 +920,64 @@ def create_consolidated_report(report_path: str):
             raise ValueError(f"{order}: more than 2 usd rows and no crypto rows")
         coinbase_pro_reformatted_rows += reformatted_rows
 
-    KRAKEN_ASSET_CODE_MAP = {
-        "XXBT": "BTC",
-        "BTC": "BTC",
-        "XETH": "ETH",
-        "ETH": "ETH",
-        "XXMR": "XMR",
-        "XMR": "XMR",
-        "SOL": "SOL",
-        "ADA": "ADA",
-        "LTC": "LTC",
-        "XXDG": "DOGE",
-        "DOGE": "DOGE",
-        "ATOM": "ATOM",
-        "DOT": "DOT",
-        "MATIC": "MATIC",
-        "LUNA": "LUNA",
-        "APE": "APE",
-        "BCH": "BCH",
-        "UST": "UST",
-        "USD": "USD",
-    }
-    # kraken
-    with open("data/kraken-ledger-alltime-040924.csv") as csv_file:
-        reader = csv.reader(csv_file)
-        rows = [row for row in reader]
-    kraken_trade_rows = [
-        row
-        for row in rows
-        if row[3] == "trade" and row[6] not in ["ZUSD", "USDT", "LUNA2"]
-    ]
-    kraken_reformatted_rows = [
-        [row[2], KRAKEN_ASSET_CODE_MAP[row[6]], row[8], "", "", "Kraken"]
-        for row in kraken_trade_rows
-    ]
-    kraken_reformatted_rows = [
-        [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").isoformat()] + row[1:]
-        for row in kraken_reformatted_rows
-    ]
+    kraken_reformatted_rows, kraken_transfer_rows = read_exchange_export(
+        EXCHANGE_ADAPTERS["Kraken"], workers=workers
+    )
+    uphold_reformatted_rows, uphold_transfer_rows = read_exchange_export(
+        EXCHANGE_ADAPTERS["Uphold"], workers=workers
+    )
 
-    with open("data/uphold-transactions-040924.csv") as csv_file:
-        reader = csv.reader(csv_file)
-        rows = [row for row in reader]
-        rows = rows[1:]
-    uphold_rows = [row for row in rows if row[-1] != "out"]
-    uphold_reformatted_rows = []
-    for row in uphold_rows:
-        date = datetime.strptime(row[0], "%a %b %d %Y %H:%M:%S GMT+0000").isoformat()
-        dest_amount = float(row[2])
-        dest_currency = row[3]
-        origin_amount = float(row[8])
-        origin_currency = row[9]
-        if dest_currency == origin_currency:
-            if dest_currency == "BAT":
-                # assume earnings, add for calculation into cost basis
-                uphold_reformatted_rows.append(
-                    [date, dest_currency, dest_amount, "", "", "Uphold"]
-                )
-        elif row[-1] == "transfer":
-            uphold_reformatted_rows.append(
-                [date, origin_currency, -1 * origin_amount, "", "", "Uphold"]
-            )
-            if dest_currency not in ["USD", "USDC", "DAI"]:
-                uphold_reformatted_rows.append(
-                    [date, dest_currency, dest_amount, "", "", "Uphold"]
-                )
-        elif row[-1] == "in":
-            assert (
-                origin_currency == "USD"
-            ), f"{date} origin currency not USD for 'in' row"
-            uphold_reformatted_rows.append(
+    # internal moves between exchanges are not buys and sells. cost basis pools
+    # are per symbol across sources, so moved lots keep their original basis
+    transfer_rows = (
+        blockfi_transfer_rows
+        + coinbase_transfer_rows
+        + coinbase_pro_transfer_rows
+        + kraken_transfer_rows
+        + uphold_transfer_rows
+    )
+    matched, unmatched_out, unmatched_in = match_transfers(
+        transfer_rows, window=transfer_window, tolerance=transfer_tolerance
+    )
+    log.info(f"matched {len(matched)} transfers between sources")
+    for row in unmatched_out:
+        log.info(f"unmatched transfer out {row[0]} {row[2]} {row[1]} from {row[5]}")
+    for row in unmatched_in:
+        log.info(f"unmatched transfer in {row[0]} {row[2]} {row[1]} to {row[5]}")
+    if unmatched_out or unmatched_in:
+        log.warning(
+            f"{len(unmatched_out)} transfers out and {len(unmatched_in)} transfers in "
+            + "unmatched, e.g. to or from wallets. see transfers.csv"
+        )
+    with open(os.path.join(report_path, "transfers.csv"), "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(
+            [
+                "Date Sent",
+                "Date Received",
+                "CryptoAsset",
+                "Amount Sent",
+                "Amount Received",
+                "From",
+                "To",
+            ]
+        )
+        for out_row, in_row in matched:
+            writer.writerow(
                 [
-                    date,
-                    dest_currency,
-                    dest_amount,
-                    origin_amount / dest_amount,
-                    origin_amount,
-                    "Uphold",
+                    out_row[0],
+                    in_row[0],
+                    out_row[1],
+                    abs(float(out_row[2])),
+                    in_row[2],
+                    out_row[5],
+                    in_row[5],
                 ]
             )
+        for row in unmatched_out:
+            writer.writerow([row[0], "", row[1], abs(float(row[2])), "", row[5], ""])
+        for row in unmatched_in:
+            writer.writerow(["", row[0], row[1], "", row[2], "", row[5]])
 
     consolidated_rows = (
         blockfi_reformatted_rows
@@ -353,68 +986,42 @@ def create_consolidated_report(report_path: str):
         + kraken_reformatted_rows
         + uphold_reformatted_rows
     )
+    # incoming transfers also booked as buys or earnings, e.g. uphold BAT, are
+    # dropped when matched to a transfer out of another source
+    matched_in = Counter(tuple(in_row) for _, in_row in matched)
+    rows_prime = []
+    for row in consolidated_rows:
+        if matched_in[tuple(row)]:
+            matched_in[tuple(row)] -= 1
+            log.debug(f"{row} matched as transfer in. ignoring...")
+            continue
+        rows_prime.append(row)
+    consolidated_rows = rows_prime
     consolidated_rows = sorted(
         consolidated_rows, key=lambda elem: datetime.fromisoformat(elem[0]).timestamp()
     )
 
-    # fill in un-filled spot prices from api
-    baseurl = "https://api.coinranking.com/v2"
-    with open(".apikey") as apikey_file:
-        apikey = apikey_file.read()
-    headers = {"x-access-token": apikey}
-
-    coin_query_str = ""
-    for c in COINS:
-        coin_query_str += f"symbols[]={c}&"
-    coin_query_str = coin_query_str[:-1]
-    req = urllib.request.Request(baseurl + "/coins?" + coin_query_str, headers=headers)
-    ret = urllib.request.urlopen(req)
-
-    coins = json.load(ret)["data"]["coins"]
-
-    coin_uuids: dict[str, str] = {}
-    coin_histories: dict[str, list] = {}
-
-    # retrieve spot price in rows where missing
+    # fill in un-filled spot prices, trying each provider in priority order
+    if price_providers is None:
+        price_providers = [CoinrankingPriceProvider()]
     rows_prime = []
     for row in consolidated_rows:
         if row[3]:
             rows_prime.append(row)
             continue
         symbol = row[1]
-
-        if coin_uuids.get(symbol):
-            coin_uuid = coin_uuids.get(symbol)
-        else:
-            if symbol == "USD": # hack
-                symbol_prime = "USDC"
-            else:
-                symbol_prime = symbol
-            coin_data = next(filter(lambda c: c["symbol"] == symbol_prime, coins), None)
-            if not coin_data:
-                raise ValueError(f"{symbol_prime} not found in list of coins from coinranking")
-            coin_uuid = coin_data["uuid"]
-            coin_uuids[symbol] = coin_uuid
-        if coin_histories.get(symbol):
-            coin_history = coin_histories.get(symbol)
-        else:
-            req = urllib.request.Request(
-                baseurl + f"/coin/{coin_uuid}/history?timePeriod=5y", headers=headers
-            )
-            ret = urllib.request.urlopen(req)
-            coin_history = json.load(ret)["data"]["history"]
-            coin_histories[symbol] = coin_history
-        timestamp = int(datetime.fromisoformat(row[0]).timestamp())
-
-        price_filter_search = filter(lambda h: h["timestamp"] < timestamp, coin_history)
-        price = next(price_filter_search)["price"]
-        while not price:
-            # weird case where price = None
-            try:
-                price = next(price_filter_search)["price"]
-            except StopIteration:
-                price = 0
+        # row dates are utc
+        date = datetime.fromisoformat(row[0]).replace(tzinfo=timezone.utc)
+        timestamp = int(date.timestamp())
+
+        price = None
+        for provider in price_providers:
+            price = provider.get_price(symbol, timestamp)
+            if price is not None:
                 break
+        if price is None:
+            log.warning(f"no price found for {symbol} at {row[0]}. using 0")
+            price = 0
 
         row_prime = row[:3] + [price] + row[4:]
         rows_prime.append(row_prime)
@@ -451,9 +1058,103 @@ def create_consolidated_report(report_path: str):
     return
 
 
-def calculate_pnl(report_path: str):
+def annotate_wash_sales(
+    pnl_rows: List[list],
+    rows: List[list],
+    pnl_lots: List[tuple],
+    window_days: int = 30,
+) -> List[list]:
+    """
+    Flag 8949 rows whose loss falls under the wash sale rule, i.e. the same
+    symbol was acquired within window_days before or after the sale and is
+    still held after it.
+
+    pnl_lots holds, for each pnl row, the consolidated row index of the lot
+    sold, the row index of the sale and the amount sold. Lots sold in the same
+    sale are never replacements, and lots bought before the sale only count
+    for the amount still held after it.
+
+    Acquisitions are indexed per symbol by time and the window found with a
+    bisect. Losses are processed in date order and consume the replacement
+    amount they use, so a repurchase is only counted against one loss. The
+    disallowed loss is prorated by the amount replaced over the amount sold.
+
+    Returns pnl_rows with code ("W" or "") and adjustment columns appended
+    """
+    window = window_days * 24 * 60 * 60
+
+    # per symbol: acquisition epochs, amounts, amounts held, amounts used as
+    # replacement, first acquisition possibly usable as replacement
+    acquisitions: dict[str, list] = {}
+    positions: dict[int, int] = {}  # row index -> index in acquisitions
+    epochs = []
+    for i, row in enumerate(rows):
+        epochs.append(datetime.fromisoformat(row[0]).timestamp())
+        amount = float(row[2].replace(",", ""))
+        if amount < 0:
+            continue
+        symbol = row[1]
+        if symbol not in acquisitions:
+            acquisitions[symbol] = [[], [], [], [], 0]
+        acquired = acquisitions[symbol]
+        positions[i] = len(acquired[0])
+        acquired[0].append(epochs[i])
+        acquired[1].append(amount)
+        acquired[2].append(amount)
+        acquired[3].append(0.0)
+
+    annotations = [["", 0] for _ in pnl_rows]
+    start = 0
+    while start < len(pnl_rows):
+        # pnl rows of the same sale
+        sale_index = pnl_lots[start][1]
+        end = start
+        while end < len(pnl_rows) and pnl_lots[end][1] == sale_index:
+            end += 1
+        symbol = rows[sale_index][1]
+        lot_epochs, amounts, held, used, first = acquisitions[symbol]
+        sold_lots = set()
+        for lot_index, _, amount in pnl_lots[start:end]:
+            held[positions[lot_index]] -= amount
+            sold_lots.add(positions[lot_index])
+
+        date_sold = epochs[sale_index]
+        while first < len(lot_epochs) and (
+            lot_epochs[first] < date_sold - window
+            or min(held[first], amounts[first] - used[first]) <= 0
+        ):
+            first += 1
+        acquisitions[symbol][4] = first
+        hi = bisect.bisect_right(lot_epochs, date_sold + window)
+
+        for k in range(start, end):
+            gain = pnl_rows[k][5]
+            if gain >= 0:
+                continue
+            amount = pnl_lots[k][2]
+            replaced = 0
+            for j in range(first, hi):
+                if replaced >= amount:
+                    break
+                if j in sold_lots:
+                    continue
+                available = min(held[j], amounts[j] - used[j])
+                if available <= 0:
+                    continue
+                replacement = min(available, amount - replaced)
+                used[j] += replacement
+                replaced += replacement
+            if replaced > 0:
+                annotations[k] = ["W", abs(gain) * min(1, replaced / amount)]
+        start = end
+
+    return [row + annotation for row, annotation in zip(pnl_rows, annotations)]
+
+
+def calculate_pnl(report_path: str, wash_sales: bool = False):
     """
-    Calculate PNL and generate 8949.csv
+    Calculate PNL and generate 8949.csv, optionally with wash sale code and
+    adjustment columns
     """
     with open(os.path.join(report_path, "consolidated.csv")) as csv_file:
         reader = csv.reader(csv_file)
@@ -463,6 +1164,8 @@ def calculate_pnl(report_path: str):
     max_unaccounted_profit = 0
 
     pnl_rows = []
+    # (row index of lot sold, row index of sale, amount) for each pnl row
+    pnl_lots = []
     cost_basis_pools = {}
     for i, row in enumerate(rows):
         # loop thru rows which are chronologically sorted
@@ -498,6 +1201,7 @@ def calculate_pnl(report_path: str):
                 remaining -= hifo_element[2]
                 if remaining > 0:
                     cost_basis_pools[symbol].remove(hifo_element)
+                    pnl_lots.append((hifo_element[0], i, hifo_element[2]))
                     pnl_rows.append(
                         [
                             f"{round(hifo_element[2], 8)} {symbol}",
@@ -524,9 +1228,10 @@ def calculate_pnl(report_path: str):
                     # replace element in cost basis pool minus sold amoint
                     replacement_element = hifo_element
                     replacement_element[2] = abs(remaining)
-                    for i, elem in enumerate(cost_basis_pools[symbol]):
+                    for j, elem in enumerate(cost_basis_pools[symbol]):
                         if elem == hifo_element:
-                            cost_basis_pools[symbol][i] = replacement_element
+                            cost_basis_pools[symbol][j] = replacement_element
+                    pnl_lots.append((hifo_element[0], i, amount))
                     pnl_rows.append(
                         [
                             f"{round(amount, 8)} {symbol}",
@@ -539,6 +1244,7 @@ def calculate_pnl(report_path: str):
                     )
                 else:  # remaining == 0
                     cost_basis_pools[symbol].remove(hifo_element)
+                    pnl_lots.append((hifo_element[0], i, hifo_element[2]))
                     pnl_rows.append(
                         [
                             f"{round(hifo_element[2], 8)} {symbol}",
@@ -553,6 +1259,14 @@ def calculate_pnl(report_path: str):
 
     log.debug(f"cost basis pools remaining: {cost_basis_pools}")
 
+    if wash_sales:
+        pnl_rows = annotate_wash_sales(pnl_rows, rows, pnl_lots)
+        wash_sale_rows = [row for row in pnl_rows if row[6] == "W"]
+        log.info(
+            f"{len(wash_sale_rows)} wash sales flagged, "
+            + f"${sum(row[7] for row in wash_sale_rows)} loss disallowed"
+        )
+
     with open(os.path.join(report_path, "8949.csv"), "w") as csv_file:
         writer = csv.writer(csv_file)
         writer.writerow(
@@ -564,33 +1278,38 @@ def calculate_pnl(report_path: str):
                 "Cost",
                 "Gains or losses",
             ]
+            + (["Code", "Adjustment"] if wash_sales else [])
         )
         writer.writerows(pnl_rows)
 
-    pnl = 0
-    for row in pnl_rows:
-        if row[2].startswith("2021"):
-            pnl += row[-1]
-    print(f"2021 Gain/Loss: ${pnl}")
-    pnl = 0
-    for row in pnl_rows:
-        if row[2].startswith("2022"):
-            pnl += row[-1]
-    print(f"2022 Gain/Loss: ${pnl}")
-    pnl = 0
-    for row in pnl_rows:
-        if row[2].startswith("2023"):
-            pnl += row[-1]
-    print(f"2023 Gain/Loss: ${pnl}")
-    pnl = 0
-    for row in pnl_rows:
-        if row[2].startswith("2024"):
-            pnl += row[-1]
-    print(f"2024 Gain/Loss: ${pnl}")
+    for year in ["2021", "2022", "2023", "2024"]:
+        pnl = 0
+        for row in pnl_rows:
+            if row[2].startswith(year):
+                pnl += row[5]
+        print(f"{year} Gain/Loss: ${pnl}")
+        if wash_sales:
+            disallowed = 0
+            for row in pnl_rows:
+                if row[2].startswith(year):
+                    disallowed += row[7]
+            print(
+                f"{year} Wash sale loss disallowed: ${disallowed}, "
+                + f"adjusted Gain/Loss: ${pnl + disallowed}"
+            )
     print(f"max unaccounted profit: ${max_unaccounted_profit}")
 
 
-def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "2023"):
+def generate_pdf(
+    csv_report_filename: str,
+    report_path: str,
+    tax_year: str = "2023",
+    wash_sales: bool = False,
+):
+    """
+    Fill form 8949 pdfs from 8949.csv. If wash_sales, rows flagged by
+    annotate_wash_sales are filled with code W and their adjustment
+    """
     with open(csv_report_filename) as csv_file:
         reader = csv.reader(csv_file)
         pnl_rows = [row for row in reader]
@@ -649,6 +1368,7 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
     total_proceeds = 0
     total_cost = 0
     total_gain_loss = 0
+    total_adjustment = 0
 
     row_index = 0
     for row in tax_rows:
@@ -662,6 +1382,7 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
                     "f1_115[0]": total_proceeds,
                     "f1_116[0]": total_cost,
                     "f1_119[0]": total_gain_loss,
+                    **({"f1_118[0]": total_adjustment} if wash_sales else {}),
                 },
             )
             pdf_writers.append(pdf_writer)
@@ -669,6 +1390,7 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
             total_proceeds = 0
             total_cost = 0
             total_gain_loss = 0
+            total_adjustment = 0
 
             row_index = 0
 
@@ -688,20 +1410,24 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
         date_sold = datetime.fromisoformat(row[2]).strftime("%m/%d/%y")
         proceeds = round(float(row[3]))
         cost = round(float(row[4]))
-        pdf_writer.update_page_form_field_values(
-            pdf_writer.pages[0],
-            {
-                tr_fields[0]: row[0],
-                tr_fields[1]: date_acquired,
-                tr_fields[2]: date_sold,
-                tr_fields[3]: proceeds,
-                tr_fields[4]: cost,
-                tr_fields[7]: proceeds - cost,
-            },
-        )
+        fields = {
+            tr_fields[0]: row[0],
+            tr_fields[1]: date_acquired,
+            tr_fields[2]: date_sold,
+            tr_fields[3]: proceeds,
+            tr_fields[4]: cost,
+        }
+        adjustment = 0
+        if wash_sales and len(row) > 7 and row[6] == "W":
+            adjustment = round(float(row[7]))
+            fields[tr_fields[5]] = row[6]
+            fields[tr_fields[6]] = adjustment
+        fields[tr_fields[7]] = proceeds - cost + adjustment
+        pdf_writer.update_page_form_field_values(pdf_writer.pages[0], fields)
         total_proceeds += proceeds
         total_cost += cost
-        total_gain_loss += proceeds - cost
+        total_adjustment += adjustment
+        total_gain_loss += proceeds - cost + adjustment
         row_index += 1
 
     pdf_writer.update_page_form_field_values(
@@ -710,6 +1436,7 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
             "f1_115[0]": total_proceeds,
             "f1_116[0]": total_cost,
             "f1_119[0]": total_gain_loss,
+            **({"f1_118[0]": total_adjustment} if wash_sales else {}),
         },
     )
     pdf_writers.append(pdf_writer)
@@ -720,6 +1447,13 @@ def generate_pdf(csv_report_filename: str, report_path: str, tax_year: str = "20
     log.info(f"8949_i.pdf reports generated in {report_path}")
 
 
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pnl", action="store_true", help="calculate pnl")
@@ -729,6 +1463,34 @@ def main():
         action="store_true",
         help="don't output pdf in addition to csv when calculating --pnl",
     )
+    parser.add_argument(
+        "--wash-sales",
+        default=False,
+        action="store_true",
+        help="flag wash sales in 8949 csv and pdf output when calculating --pnl",
+    )
+    parser.add_argument(
+        "--price-dir",
+        help="directory of <SYMBOL>.csv ohlc files to source spot prices from "
+        + "before falling back to the coinranking api",
+    )
+    parser.add_argument(
+        "--transfer-window",
+        type=float,
+        default=72,
+        help="hours within which a transfer must arrive to match its withdrawal",
+    )
+    parser.add_argument(
+        "--transfer-tolerance",
+        type=float,
+        default=0.05,
+        help="fraction of a transfer that may be lost to fees and still match",
+    )
+    parser.add_argument(
+        "--workers",
+        type=_positive_int,
+        help="number of processes used to parse large exchange exports",
+    )
 
     args = parser.parse_args()
 
@@ -747,11 +1509,25 @@ def main():
     log.addHandler(fh)
     log.addHandler(sh)
 
-    create_consolidated_report(report_subdir)
+    price_providers = [CoinrankingPriceProvider()]
+    if args.price_dir:
+        price_providers.insert(0, CsvPriceProvider(args.price_dir))
+
+    create_consolidated_report(
+        report_subdir,
+        price_providers=price_providers,
+        workers=args.workers,
+        transfer_window=int(args.transfer_window * 60 * 60),
+        transfer_tolerance=args.transfer_tolerance,
+    )
     if args.pnl:
-        calculate_pnl(report_subdir)
+        calculate_pnl(report_subdir, wash_sales=args.wash_sales)
         if not args.no_pdf:
-            generate_pdf(os.path.join(report_subdir, "8949.csv"), report_subdir)
+            generate_pdf(
+                os.path.join(report_subdir, "8949.csv"),
+                report_subdir,
+                wash_sales=args.wash_sales,
+            )
 
 
 if __name__ == "__main__":